@@ -138,18 +138,38 @@ class VirtualNode:
             # Namespace doesn't exist. Return silently.
             pass
 
+    def ifdown(self):
+        """
+        Brings the network interface of the virtual node down, by bringing
+        down its veth peer on the bridge side.
+        """
+        with IPRoute() as ipr:
+            ipr.link('set', ifname=self.vethPeer, state='down')
+
+    def ifup(self):
+        """
+        Brings the network interface of the virtual node back up.
+        """
+        with IPRoute() as ipr:
+            ipr.link('set', ifname=self.vethPeer, state='up')
+
     def run(self, command, user=os.getenv("USER")):
         """
         Executes a command under the given user from this virtual node. Returns
         a context manager that returns NSOpen object to control the process.
         NSOpen has the same API as subprocess.POpen.
+
+        These are short-lived commands, so we don't have subprocess close all
+        the possible file descriptors before running them: Python opens its
+        file descriptors as non-inheritable (PEP 446), and so does libpq for
+        its connections, so only the pipes we ask for are inherited anyway.
         """
         sudo_command = ['sudo', '-E', '-u', user,
                         'env', 'PATH=' + os.getenv("PATH")] + command
         return managed_nspopen(self.namespace, sudo_command,
                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE, universal_newlines=True,
-                               start_new_session=True)
+                               start_new_session=True, close_fds=False)
 
     def run_unmanaged(self, command, user=os.getenv("USER")):
         """
@@ -158,11 +178,14 @@ class VirtualNode:
         subprocess.Popen. This NSPopen object needs to be manually release. In
         general you should prefer using run, where this is done automatically
         by the context manager.
+
+        The process stdin is /dev/null: nothing ever writes to it, and the
+        NSPopen proxy then only has the stdout and stderr pipes to drain.
         """
         sudo_command = ['sudo', '-E', '-u', user,
                         'env', 'PATH=' + os.getenv("PATH")] + command
         return NSPopen(self.namespace, sudo_command,
-                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
                        stderr=subprocess.PIPE, universal_newlines=True,
                        start_new_session=True)
 
@@ -1,33 +1,151 @@
 import os
 import os.path
+import select
 import signal
 import shutil
 import time
 import network
 import psycopg2
 import subprocess
-import datetime as dt
+import sys
+import threading
+import collections
+import contextlib
+import concurrent.futures
+import functools
+import itertools
 from enum import Enum
 
 COMMAND_TIMEOUT = network.COMMAND_TIMEOUT
-POLLING_INTERVAL = 0.1
+MIN_POLLING_INTERVAL = 0.025
+MAX_POLLING_INTERVAL = 1
+DRAIN_INTERVAL = 1
 STATE_CHANGE_TIMEOUT = 90
 PGVERSION = os.getenv("PGVERSION", "11")
+EVENTS_CACHE_TTL = 1
+EVENTS_HEADER = "%s %25s:%-14s %17s/%-17s %7s %10s %s" % \
+    ("eventtime", "id", "nodename", "state", "goal state",
+     "repl st", "lsn", "event")
+STATE_FORMAT = "%25s:%-5s %5s %5s %17s/%-17s %8s %6s"
+STATE_HEADER = STATE_FORMAT % \
+    ("nodename", "port", "group", "id", "state", "goal state",
+     "priority", "quorum")
+
+@functools.lru_cache(maxsize=None)
+def _which(program):
+    """
+    Returns the full path to the given program, as shutil.which() does, only
+    walking the PATH the first time we're asked about a program.
+    """
+    return shutil.which(program)
+
+# the programs we run the most, resolved once when loading this module
+PG_AUTOCTL = _which('pg_autoctl')
+PSQL = _which('psql')
+
+def _remove_if_exists(path):
+    """
+    Removes the given file, when it exists.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+StateNotification = collections.namedtuple(
+    "StateNotification",
+    ["reported_state", "goal_state", "formation", "group", "nodeid",
+     "nodename", "port"])
+
+def parse_state_notification(payload):
+    """
+    Parses the payload of a notification on the monitor state channel, which
+    looks like "S:reported:goal:len.formation:group:nodeid:len.nodename:port",
+    and returns a StateNotification, or None when the payload is not a state
+    change.
+    """
+    try:
+        kind, reported, goal, rest = payload.split(":", 3)
+        if kind != "S":
+            return None
+
+        # the formation and the nodename are prefixed with their length
+        size, rest = rest.split(".", 1)
+        formation, rest = rest[:int(size)], rest[int(size) + 1:]
+
+        group, nodeid, rest = rest.split(":", 2)
+
+        size, rest = rest.split(".", 1)
+        nodename, port = rest[:int(size)], rest[int(size) + 1:]
+
+        return StateNotification(reported, goal, formation,
+                                 int(group), int(nodeid), nodename, int(port))
+    except ValueError:
+        return None
+
+def _notifications_concern(notifies, datanodes):
+    """
+    Returns True when any of the given monitor notifications might be about
+    one of the given data nodes.
+    """
+    nodes = {(node.nodeid, node.group) for node in datanodes}
+
+    for notify in notifies:
+        state = parse_state_notification(notify.payload)
+        if state is None or (state.nodeid, state.group) in nodes:
+            return True
+
+    return False
+
+def _pid_is_alive(pid):
+    """
+    Returns True when a process with the given pid exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, it belongs to another user
+        return True
+    return True
+
+def _conn_is_stale(conn):
+    """
+    Returns True when the server already closed the given idle connection, as
+    it does when Postgres is restarted. We need to know before sending a
+    query: once it's sent, we can't tell whether the server ran it.
+    """
+    if conn.closed != 0:
+        return True
+
+    try:
+        # an idle connection has nothing to read, unless the server is gone
+        if select.select([conn], [], [], 0) == ([], [], []):
+            return False
+        conn.poll()
+    except (psycopg2.Error, OSError):
+        return True
+    return conn.closed != 0
+
+def _log_file_header(name):
+    """
+    Returns the line we print before the contents of the given log file.
+    """
+    return b"\n\n%s:\n" % name.encode()
 
 class Role(Enum):
-    Monitor = 1
-    Postgres = 2
-    Coordinator = 3
-    Worker = 4
+    Monitor = "monitor"
+    Postgres = "postgres"
+    Coordinator = "coordinator"
+    Worker = "worker"
 
     def command(self):
-        return self.name.lower()
+        return self.value
 
 class Feature(Enum):
-    Secondary = 1
+    Secondary = "secondary"
 
     def command(self):
-        return self.name.lower()
+        return self.value
 
 class Cluster:
     # Docker uses 172.17.0.0/16 by default, so we use 172.27.1.0/24 to not
@@ -88,6 +206,41 @@ class Cluster:
         self.datanodes.append(datanode)
         return datanode
 
+    def create_datanodes_parallel(self, specs):
+        """
+        Initializes a data node for each dict of create_datanode arguments in
+        specs, then does the "keeper init" and "pg_autoctl run" commands for
+        all of them at once. Returns the list of DataNode instances, in the
+        same order as specs.
+
+        The monitor assigns node ids in the order nodes register, which we
+        don't control here, so we ask the monitor about them afterwards.
+        """
+        datanodes = [self.create_datanode(**spec) for spec in specs]
+
+        def create_and_run(datanode):
+            datanode.create()
+            datanode.run()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(datanodes) or 1) as executor:
+            for f in [executor.submit(create_and_run, datanode)
+                      for datanode in datanodes]:
+                f.result()
+
+        for datanode in datanodes:
+            nodename = datanode.config_get("pg_autoctl.nodename")
+            results = self.monitor.run_sql_query(
+                "select nodeid, groupid from pgautofailover.node "
+                "where nodename = %s and nodeport = %s",
+                nodename, datanode.port)
+            if not results:
+                raise Exception(f"node {nodename}:{datanode.port} "
+                                "not found on the monitor")
+            datanode.nodeid, datanode.group = results[0]
+
+        return datanodes
+
     def pg_createcluster(self, datadir, port=5432):
         """
         Initializes a postgresql node using pg_createcluster and returns
@@ -95,21 +248,21 @@ class Cluster:
         """
         vnode = self.vlan.create_node()
 
-        create_command = ["sudo", shutil.which('pg_createcluster'),
+        create_command = ["sudo", _which('pg_createcluster'),
                           "-U", os.getenv("USER"),
                           PGVERSION, datadir, '-p', str(port)]
 
-        print("%s" % " ".join(create_command))
+        print(" ".join(create_command))
 
         vnode.run_and_wait(create_command, "pg_createcluster")
 
         abspath = os.path.join("/var/lib/postgresql/", PGVERSION, datadir)
 
-        chmod_command = ["sudo", shutil.which('install'),
+        chmod_command = ["sudo", _which('install'),
                          '-d', '-o', os.getenv("USER"),
-                         "/var/lib/postgresql/%s/backup" % PGVERSION]
+                         f"/var/lib/postgresql/{PGVERSION}/backup"]
 
-        print("%s" % " ".join(chmod_command))
+        print(" ".join(chmod_command))
         vnode.run_and_wait(chmod_command, "chmod")
 
         return abspath
@@ -118,12 +271,118 @@ class Cluster:
         """
         Cleanup whatever was created for this Cluster.
         """
-        for datanode in self.datanodes:
-            datanode.destroy()
+        for node in self.nodes():
+            node.close_connections()
+
+        # data nodes are independent from each other, destroy them all at
+        # once; the monitor is still needed until they are all gone though
+        if self.datanodes:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(self.datanodes)) as executor:
+                for f in [executor.submit(datanode.destroy)
+                          for datanode in self.datanodes]:
+                    f.result()
+
         if self.monitor:
             self.monitor.destroy()
         self.vlan.destroy()
 
+    def wait_until_states(self, targets,
+                          timeout=STATE_CHANGE_TIMEOUT,
+                          sleep_time=MIN_POLLING_INTERVAL):
+        """
+        Waits until each data node of the targets dict reaches its target
+        state, and then returns True. If this doesn't happen until "timeout"
+        seconds, prints the debug logs and raises an Exception that lists the
+        nodes that didn't reach their target state.
+
+        Rather than polling the monitor at a fixed interval, we LISTEN to the
+        monitor state notifications and only query the current states when
+        something happened to one of the nodes we're waiting for, or when our
+        polling interval expires. The polling interval doubles at each wait in
+        which nothing happened, up to MAX_POLLING_INTERVAL. The states of all
+        the nodes we're waiting for are fetched with a single query.
+        """
+        pending = dict(targets)
+        prev_states = {}
+        refresh = True
+        wait_until = time.monotonic() + timeout
+        while True:
+            if refresh:
+                current_states = self.get_states(pending.keys())
+
+                for node, target_state in list(pending.items()):
+                    current_state = current_states[node]
+
+                    # only log the state if it has changed
+                    if current_state != prev_states.get(node):
+                        if current_state == target_state:
+                            print(f"state of {node.datadir} is "
+                                  f"'{current_state}', done waiting")
+                        else:
+                            print(f"state of {node.datadir} is "
+                                  f"'{current_state}', "
+                                  f"waiting for '{target_state}' ...")
+
+                    if current_state == target_state:
+                        del pending[node]
+
+                    prev_states[node] = current_state
+
+                if not pending:
+                    return True
+
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                break
+
+            notifies = self.monitor.wait_for_notify(min(sleep_time, remaining))
+
+            if notifies:
+                refresh = _notifications_concern(notifies, pending.keys())
+            else:
+                # nothing happened, wait longer next time
+                refresh = True
+                sleep_time = min(sleep_time * 2, MAX_POLLING_INTERVAL)
+
+        error_msg = ""
+        for node, target_state in pending.items():
+            print(f"{node.datadir} didn't reach {target_state} "
+                  f"after {timeout} seconds")
+            error_msg += (f"{node.datadir} failed to reach {target_state} "
+                          f"after {timeout} seconds\n")
+        next(iter(pending)).print_debug_logs()
+        raise Exception(error_msg)
+
+    def get_states(self, datanodes):
+        """
+        Returns a dict of the current state of each of the given data nodes.
+        This is done by querying the monitor node, once for all the nodes.
+        """
+        nodes = {(node.nodeid, node.group): node for node in datanodes}
+
+        if len(nodes) == 1:
+            # use the prepared statement of DataNode.get_state
+            node = next(iter(nodes.values()))
+            return {node: node.get_state()}
+
+        results = self.monitor.run_sql_query(
+            """
+SELECT nodeid, groupid, reportedstate
+  FROM pgautofailover.node
+ WHERE (nodeid, groupid) IN %s
+""",
+            tuple(nodes.keys()))
+
+        states = {nodes[(nodeid, groupid)]: state
+                  for nodeid, groupid, state in results}
+
+        for (nodeid, groupid), node in nodes.items():
+            if node not in states:
+                raise Exception(f"node {nodeid} in group {groupid} "
+                                "not found on the monitor")
+        return states
+
     def nodes(self):
         """
         Returns a list of all nodes in the cluster including the monitor
@@ -136,45 +395,20 @@ class Cluster:
             nodes.append(self.monitor)
         return nodes
 
-    def flush_output(self):
-        """
-        flush the output for all running pg_autoctl processes in the cluster
-        """
-        for node in self.nodes():
-            node.flush_output()
-
     def sleep(self, secs):
         """
-        sleep for the specified time while flushing output of the cluster at
-        least every second
+        sleep for the specified time. The output of the running pg_autoctl
+        processes is read in the background, see PGAutoCtl.run
         """
-        full_secs = int(secs)
-
-        for i in range(full_secs):
-            self.flush_output()
-            time.sleep(1)
-
-        self.flush_output()
-        time.sleep(secs - full_secs)
+        time.sleep(secs)
 
     def communicate(self, proc, timeout):
         """
-        communicate with the process with the specified timeout while flushing
-        output of the cluster at least every second
+        communicate with the process with the specified timeout. The output of
+        the running pg_autoctl processes is read in the background, see
+        PGAutoCtl.run
         """
-        full_secs = int(timeout)
-
-        for i in range(full_secs):
-            self.flush_output()
-            try:
-                # wait until process is done for one second each iteration
-                # of this loop, to add up to the actual timeout argument
-                return proc.communicate(timeout=1)
-            except subprocess.TimeoutExpired:
-                pass
-
-        self.flush_output()
-        return proc.communicate(timeout=timeout - full_secs)
+        return proc.communicate(timeout=timeout)
 
 
 class PGNode:
@@ -204,34 +438,84 @@ class PGNode:
         self._pgversion = None
         self._pgmajor = None
 
+        # Config file is located at:
+        # ~/.config/pg_autoctl/${PGDATA}/pg_autoctl.cfg
+        # State file is located at:
+        # ~/.local/share/pg_autoctl/${PGDATA}/pg_autoctl.state
+        home = os.environ["HOME"]
+        pgdata = os.path.abspath(self.datadir)[1:] # Remove the starting '/'
+        self._config_file_path = os.path.join(home,
+                                              ".config/pg_autoctl",
+                                              pgdata,
+                                              "pg_autoctl.cfg")
+        self._state_file_path = os.path.join(home,
+                                             ".local/share/pg_autoctl",
+                                             pgdata,
+                                             "pg_autoctl.state")
+
+        # connection parameters, see _build_dsn
+        self._dsn_cache = None
+        self._dsn_kwargs = None
+
+        # connection reused by run_sql_query, see _get_conn
+        self._conn = None
+        self._prepared = set()
+
     def connection_string(self):
         """
         Returns a connection string which can be used to connect to this postgres
         node.
         """
+        return self._dsn_cache or self._build_dsn()
+
+    def _connection_kwargs(self):
+        """
+        Returns the connection parameters of this postgres node as keywords
+        arguments for psycopg2.connect().
+        """
+        if self._dsn_kwargs is None:
+            self._build_dsn()
+        return self._dsn_kwargs
+
+    def _build_dsn(self):
+        """
+        Computes both the connection string and the connection keywords for
+        this postgres node, and caches them until _invalidate_dsn is called.
+        """
         host = self.vnode.address
+        kwargs = {'host': str(host),
+                  'port': self.port,
+                  'user': self.username,
+                  'dbname': self.database}
 
         if (self.authMethod and self.username in self.authenticatedUsers):
-            dsn = "postgres://%s:%s@%s:%d/%s" % \
-                (self.username,
-                 self.authenticatedUsers[self.username],
-                 host,
-                 self.port,
-                 self.database)
+            kwargs['password'] = self.authenticatedUsers[self.username]
+            dsn = (f"postgres://{self.username}:"
+                   f"{self.authenticatedUsers[self.username]}"
+                   f"@{host}:{self.port}/{self.database}")
         else:
-            dsn = "postgres://%s@%s:%d/%s" % \
-                (self.username,
-                 host,
-                 self.port,
-                 self.database)
+            dsn = (f"postgres://{self.username}"
+                   f"@{host}:{self.port}/{self.database}")
 
         if self.sslMode:
             # If a local CA is used, or even a self-signed certificate,
             # using verify-ca often provides enough protection.
-            dsn += "?sslmode=%s" % self.sslMode
+            kwargs['sslmode'] = self.sslMode
+            dsn += f"?sslmode={self.sslMode}"
 
+        self._dsn_kwargs = kwargs
+        self._dsn_cache = dsn
         return dsn
 
+    def _invalidate_dsn(self):
+        """
+        Forgets about the connection parameters computed for this node, and
+        about the connection opened with them, because they changed.
+        """
+        self._dsn_cache = None
+        self._dsn_kwargs = None
+        self.close_connections()
+
     def run(self, env={}):
         """
         Runs "pg_autoctl run"
@@ -242,14 +526,6 @@ class PGNode:
     def running(self):
         return self.pg_autoctl and self.pg_autoctl.run_proc
 
-    def flush_output(self):
-        """
-        Flushes the output of pg_autoctl if it's running to be sure that it
-        does not get stuck, because of a filled up pipe.
-        """
-        if self.running():
-            self.pg_autoctl.consume_output(0.001)
-
     def sleep(self, secs):
         """
         Sleep for the specfied amount of seconds but meanwile consume output of
@@ -260,37 +536,103 @@ class PGNode:
         else:
             time.sleep(secs)
 
+    def _get_conn(self):
+        """
+        Returns a connection to this postgres node, reusing the one we opened
+        previously when it's still usable.
+        """
+        if self._conn is not None:
+            if not _conn_is_stale(self._conn):
+                return self._conn
+
+            # Postgres might have been restarted since we last used our
+            # connection, in which case we connect again
+            self._conn.close()
+
+        self._conn = psycopg2.connect(**self._connection_kwargs())
+        self._conn.autocommit = True
+
+        # prepared statements belong to the connection they were prepared on
+        self._prepared = set()
+        return self._conn
+
     def run_sql_query(self, query, *args):
         """
         Runs the given sql query with the given arguments in this postgres node
         and returns the results. Returns None if there are no results to fetch.
         """
-        with psycopg2.connect(self.connection_string()) as conn:
-            cur = conn.cursor()
+        # we don't retry on errors, the server might have run the query
+        # already: see _get_conn for connections that Postgres closed
+        with self._get_conn().cursor() as cur:
             cur.execute(query, args)
             try:
-                result = cur.fetchall()
-                return result
+                return cur.fetchall()
+            except psycopg2.ProgrammingError:
+                return None
+
+    def run_prepared(self, name, query, *args):
+        """
+        Runs the given sql query with the given arguments in this postgres node
+        and returns the results, as run_sql_query does. The query is run as a
+        server-side prepared statement with the given name, which we PREPARE
+        the first time it's used on our connection. The query refers to its
+        arguments as $1, $2, etc.
+
+        As in run_sql_query, we don't retry on errors. When _get_conn has to
+        connect again, the query is prepared again on the new connection.
+        """
+        conn = self._get_conn()
+        with conn.cursor() as cur:
+            if name not in self._prepared:
+                cur.execute(f"PREPARE {name} AS {query}")
+                self._prepared.add(name)
+
+            if args:
+                placeholders = ", ".join(["%s"] * len(args))
+                cur.execute(f"EXECUTE {name}({placeholders})", args)
+            else:
+                cur.execute(f"EXECUTE {name}")
+            try:
+                return cur.fetchall()
             except psycopg2.ProgrammingError:
                 return None
 
+    def close_connections(self):
+        """
+        Closes the connections this node keeps open to Postgres.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
     def pg_config_get(self, setting):
         """
         Returns the current value of the given postgres setting"
         """
-        return self.run_sql_query(f"SHOW {setting}")[0][0]
+        return self.pg_config_get_many([setting])[setting]
+
+    def pg_config_get_many(self, settings):
+        """
+        Returns a dict with the current value of each of the given postgres
+        settings, fetched in a single query. Values are the same as the ones
+        SHOW returns.
+        """
+        query = "select name, current_setting(name) " \
+            + "from unnest(%s::text[]) as t(name)"
+        return dict(self.run_sql_query(query, list(settings)))
 
     def set_user_password(self, username, password):
         """
         Sets user passwords on the PGNode
         """
         alter_user_set_passwd_command = \
-            "alter user %s with password \'%s\'" % (username, password)
-        passwd_command = [shutil.which('psql'),
+            f"alter user {username} with password '{password}'"
+        passwd_command = [PSQL,
                           '-d', self.database,
                           '-c', alter_user_set_passwd_command]
         self.vnode.run_and_wait(passwd_command, name="user passwd")
         self.authenticatedUsers[username] = password
+        self._invalidate_dsn()
 
     def stop_pg_autoctl(self):
         """
@@ -316,39 +658,86 @@ class PGNode:
         # The second command will not finish, since the first restarts postgres
         # before the second finds out it has been killed.
 
-        for i in range(60):
-            stop_command = [shutil.which('pg_ctl'), '-D', self.datadir,
-                            '--wait', '--mode', 'fast', 'stop']
-            try:
-                with self.vnode.run(stop_command) as stop_proc:
-                    out, err = stop_proc.communicate(timeout=1)
+        stop_command = [_which('pg_ctl'), '-D', self.datadir,
+                        '--wait', '--mode', 'fast', 'stop']
+
+        # So we run pg_ctl stop once, and only run it again when we find out
+        # that the postmaster it was waiting for is gone and another one has
+        # been started in the meantime. All of it has to be done within
+        # COMMAND_TIMEOUT though, however many races we lose.
+        pid = self.postmaster_pid()
+        races = 0
+        wait_until = time.monotonic() + COMMAND_TIMEOUT
+
+        while races < 60:
+            with self.vnode.run(stop_command) as stop_proc:
+                new_pid = None
+                while new_pid is None:
+                    try:
+                        out, err = stop_proc.communicate(timeout=1)
+                    except subprocess.TimeoutExpired:
+                        if time.monotonic() > wait_until:
+                            stop_proc.kill()
+                            raise Exception(
+                                f"Postgres could not be stopped after "
+                                f"{COMMAND_TIMEOUT} seconds")
+                        new_pid = self._restarted_postmaster_pid(pid)
+                        continue
+
                     if stop_proc.returncode > 0:
-                        print("stopping postgres for '%s' failed, out: %s\n, err: %s"
-                              % (self.vnode.address, out, err))
-                        return False
-                    elif stop_proc.returncode is None:
-                        print("stopping postgres for '%s' timed out")
+                        print(f"stopping postgres for '{self.vnode.address}' "
+                              f"failed, out: {out}\n, err: {err}")
                         return False
                     return True
-            except subprocess.TimeoutExpired:
-                pass
+
+                # we lost the race, stop the new postmaster now
+                pid = new_pid
+                races += 1
         else:
             raise Exception("Postgres could not be stopped after 60 attempts")
 
+    def _restarted_postmaster_pid(self, pid):
+        """
+        Returns the pid of the postmaster that has been started after the one
+        with the given pid was stopped, or None when that did not happen.
+        """
+        if pid is not None and _pid_is_alive(pid):
+            # postgres is still shutting down
+            return None
+
+        new_pid = self.postmaster_pid()
+        if new_pid == pid:
+            return None
+        return new_pid
+
+    def postmaster_pid(self):
+        """
+        Returns the pid found in the postmaster.pid file of this node, or None
+        when there is no such file.
+        """
+        pidfile = os.path.join(self.datadir, 'postmaster.pid')
+        try:
+            with open(pidfile, "r") as p:
+                return int(p.readline())
+        except (FileNotFoundError, ValueError):
+            # the file could also be in the middle of being written
+            return None
+
     def reload_postgres(self):
         """
         Reload the postgres configuration by running:
           pg_ctl -D ${self.datadir} reload
         """
-        reload_command = [shutil.which('pg_ctl'), '-D', self.datadir, 'reload']
+        reload_command = [_which('pg_ctl'), '-D', self.datadir, 'reload']
         with self.vnode.run(reload_command) as reload_proc:
             out, err = self.cluster.communicate(reload_proc, COMMAND_TIMEOUT)
             if reload_proc.returncode > 0:
-                print("reloading postgres for '%s' failed, out: %s\n, err: %s"
-                      % (self.vnode.address, out, err))
+                print(f"reloading postgres for '{self.vnode.address}' "
+                      f"failed, out: {out}\n, err: {err}")
                 return False
             elif reload_proc.returncode is None:
-                print("reloading postgres for '%s' timed out")
+                print(f"reloading postgres for '{self.vnode.address}' "
+                      "timed out")
                 return False
             return True
 
@@ -357,62 +746,74 @@ class PGNode:
         Restart the postgres configuration by running:
           pg_ctl -D ${self.datadir} restart
         """
-        restart_command = [shutil.which('pg_ctl'), '-D', self.datadir, 'restart']
+        restart_command = [_which('pg_ctl'), '-D', self.datadir, 'restart']
         with self.vnode.run(restart_command) as restart_proc:
             out, err = self.cluster.communicate(restart_proc, COMMAND_TIMEOUT)
             if restart_proc.returncode > 0:
-                print("restarting postgres for '%s' failed, out: %s\n, err: %s"
-                      % (self.vnode.address, out, err))
+                print(f"restarting postgres for '{self.vnode.address}' "
+                      f"failed, out: {out}\n, err: {err}")
                 return False
             elif restart_proc.returncode is None:
-                print("restarting postgres for '%s' timed out")
+                print(f"restarting postgres for '{self.vnode.address}' "
+                      "timed out")
                 return False
             return True
 
-    def pg_is_running(self, timeout=COMMAND_TIMEOUT):
-        """
-        Returns true when Postgres is running. We use pg_ctl status.
-        """
-        status_command = [shutil.which('pg_ctl'), '-D', self.datadir, 'status']
-        with self.vnode.run(status_command) as status_proc:
-            out, err = self.cluster.communicate(status_proc, timeout)
-            if status_proc.returncode == 0:
-                # pg_ctl status is happy to report 0 (Postgres is running) even
-                # when it's still "starting" and thus not ready for queries.
-                #
-                # because our tests need to be able to send queries to Postgres,
-                # the "starting" status is not good enough for us, we're only
-                # happy with "ready".
-                pidfile = os.path.join(self.datadir, 'postmaster.pid')
-                try:
-                    with open(pidfile, "r") as p:
-                        pidlines = p.readlines()
-                        if len(pidlines) > 7:
-                            pg_status = pidlines[7]
-                            return pg_status.startswith("ready")
-                except FileNotFoundError:
-                    # It's possible that the pidfile or pgdata does not exist yet.
-                    # Obviously postgres is not running in that case
-                    return False
-            elif status_proc.returncode > 0:
-                # ignore `pg_ctl status` output, silently try again till timeout
-                return False
-            elif status_proc.returncode is None:
-                print("pg_ctl status timed out after %ds" % timeout)
-                return False
+    def pg_is_running(self):
+        """
+        Returns true when Postgres is running. Rather than running pg_ctl
+        status, we do the same checks it does directly: postmaster.pid exists
+        and the process it refers to is still alive.
+        """
+        pidfile = os.path.join(self.datadir, 'postmaster.pid')
+        try:
+            with open(pidfile, "r") as p:
+                pidlines = p.readlines()
+        except FileNotFoundError:
+            # It's possible that the pidfile or pgdata does not exist yet.
+            # Obviously postgres is not running in that case
+            return False
+
+        try:
+            pid = int(pidlines[0])
+        except (IndexError, ValueError):
+            # the file is still being written
+            return False
+
+        if not _pid_is_alive(pid):
+            # a stale pidfile, left behind by a crash
+            return False
+
+        # Postgres is running even when it's still "starting" and thus not
+        # ready for queries.
+        #
+        # because our tests need to be able to send queries to Postgres,
+        # the "starting" status is not good enough for us, we're only
+        # happy with "ready".
+        return len(pidlines) > 7 and pidlines[7].startswith("ready")
 
     def wait_until_pg_is_running(self, timeout=STATE_CHANGE_TIMEOUT):
         """
         Waits until the underlying Postgres process is running.
+
+        We check again with an exponential backoff, up to MAX_POLLING_INTERVAL.
         """
-        wait_until = dt.datetime.now() + dt.timedelta(seconds=timeout)
-        while wait_until > dt.datetime.now():
+        wait_until = time.monotonic() + timeout
+        sleep_time = MIN_POLLING_INTERVAL
+
+        while True:
             if self.pg_is_running():
                 return True
-            time.sleep(POLLING_INTERVAL)
 
-        print("Postgres is still not running in %s after %d seconds" %
-              (self.datadir, timeout))
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                break
+
+            time.sleep(min(sleep_time, remaining))
+            sleep_time = min(sleep_time * 2, MAX_POLLING_INTERVAL)
+
+        print(f"Postgres is still not running in {self.datadir} "
+              f"after {timeout} seconds")
         return False
 
     def fail(self):
@@ -428,42 +829,29 @@ class PGNode:
         """
         Returns the path of the config file for this data node.
         """
-        # Config file is located at:
-        # ~/.config/pg_autoctl/${PGDATA}/pg_autoctl.cfg
-        home = os.getenv("HOME")
-        pgdata = os.path.abspath(self.datadir)[1:] # Remove the starting '/'
-        return os.path.join(home,
-                            ".config/pg_autoctl",
-                            pgdata,
-                            "pg_autoctl.cfg")
+        return self._config_file_path
 
     def state_file_path(self):
         """
         Returns the path of the state file for this data node.
         """
-        # State file is located at:
-        # ~/.local/share/pg_autoctl/${PGDATA}/pg_autoctl.state
-        home = os.getenv("HOME")
-        pgdata = os.path.abspath(self.datadir)[1:] # Remove the starting '/'
-        return os.path.join(home,
-                            ".local/share/pg_autoctl",
-                            pgdata,
-                            "pg_autoctl.state")
+        return self._state_file_path
 
-    def get_postgres_logs(self):
+    def postgres_log_files(self):
+        """
+        Returns the list of the (name, path) of the Postgres log files of this
+        node, sorted by name, and then the configuration files that we want to
+        see too.
+        """
         ldir = os.path.join(self.datadir, "log")
         try:
-            logfiles = os.listdir(ldir)
+            with os.scandir(ldir) as it:
+                files = [(name, os.path.join(ldir, name))
+                         for name in sorted(entry.name for entry in it)]
         except FileNotFoundError:
             # If the log directory does not exist then there's also no logs to
             # display
-            return ""
-        logfiles.sort()
-
-        logs = []
-        for logfile in logfiles:
-            logs += ["\n\n%s:\n" % logfile]
-            logs += open(os.path.join(ldir, logfile)).readlines()
+            return []
 
         # it's not really logs but we want to see that too
         for inc in ["recovery.conf",
@@ -472,10 +860,50 @@ class PGNode:
                     "postgresql-auto-failover-standby.conf"]:
             conf = os.path.join(self.datadir, inc)
             if os.path.isfile(conf):
-                logs += ["\n\n%s:\n" % conf]
-                logs += open(conf).readlines()
+                files.append((conf, conf))
 
-        return "".join(logs)
+        return files
+
+    def get_postgres_logs(self):
+        # read each file in a single bytes object rather than line by line
+        logs = []
+        for name, path in self.postgres_log_files():
+            logs.append(_log_file_header(name))
+            with open(path, "rb") as f:
+                logs.append(f.read())
+
+        return b"".join(logs).decode("utf-8", errors="replace")
+
+    def dump_postgres_logs(self, out=None):
+        """
+        Writes the Postgres logs of this node to the given binary file object,
+        sys.stdout.buffer by default, using os.sendfile so that the kernel
+        copies the files for us. When sendfile can't write there, for instance
+        to a file opened with O_APPEND, we copy the files ourselves.
+        """
+        if out is None:
+            out = sys.stdout.buffer
+
+        for name, path in self.postgres_log_files():
+            out.write(_log_file_header(name))
+            # make sure the header is written before the file contents
+            out.flush()
+
+            with open(path, "rb") as f:
+                offset = 0
+                try:
+                    size = os.fstat(f.fileno()).st_size
+                    while offset < size:
+                        sent = os.sendfile(out.fileno(), f.fileno(),
+                                           offset, size - offset)
+                        if sent == 0:
+                            # the file got truncated under our feet
+                            break
+                        offset += sent
+                except OSError:
+                    f.seek(offset)
+                    shutil.copyfileobj(f, out)
+        out.flush()
 
     def pgversion(self):
         """
@@ -499,12 +927,9 @@ class PGNode:
 
     def ifdown(self):
         """
-        Set a configuration parameter to given value
+        Bring the network interface down for this node
         """
-        command = PGAutoCtl(self)
-        command.execute("config set %s" % setting,
-                        'config', 'set', setting, value)
-        return True
+        self.vnode.ifdown()
 
     def ifup(self):
         """
@@ -517,7 +942,7 @@ class PGNode:
         Set a configuration parameter to given value
         """
         command = PGAutoCtl(self)
-        command.execute("config set %s" % setting,
+        command.execute(f"config set {setting}",
                         'config', 'set', setting, value)
         return True
 
@@ -526,7 +951,7 @@ class PGNode:
         Set a configuration parameter to given value
         """
         command = PGAutoCtl(self)
-        out, err = command.execute("config get %s" % setting,
+        out, err = command.execute(f"config get {setting}",
                                    'config', 'get', setting)
         return out[:-1]
 
@@ -541,24 +966,58 @@ class PGNode:
             out, err = command.execute("show uri", 'show', 'uri')
         return out
 
-    def logs(self):
+    def pg_autoctl_logs(self):
         log_string = ""
         if self.running():
             out, err = self.stop_pg_autoctl()
             log_string += f"STDOUT OF PG_AUTOCTL FOR {self.datadir}:\n{out}\n"
             log_string += f"STDERR OF PG_AUTOCTL FOR {self.datadir}:\n{err}\n"
+        return log_string
 
+    def logs(self):
+        log_string = self.pg_autoctl_logs()
         pglogs = self.get_postgres_logs()
         log_string += f"POSTGRES LOGS FOR {self.datadir}:\n{pglogs}\n"
         return log_string
 
     def print_debug_logs(self):
         events = self.get_events_str()
-        logs = f"MONITOR EVENTS:\n{events}\n"
+        print(f"MONITOR EVENTS:\n{events}")
+
+        out = getattr(sys.stdout, "buffer", None)
+        if out is None:
+            # stdout is not a real file (captured output), print it all
+            for node in self.cluster.nodes():
+                print(node.logs())
+            return
 
         for node in self.cluster.nodes():
-            logs += node.logs()
-        print(logs)
+            print(node.pg_autoctl_logs(), end="")
+            print(f"POSTGRES LOGS FOR {node.datadir}:")
+
+            # make sure what we printed is written before the logs
+            sys.stdout.flush()
+            node.dump_postgres_logs(out)
+            print()
+
+    def ssl_args(self):
+        """
+        Returns the pg_autoctl command line options for our SSL settings
+        """
+        ssl_options = [
+            (self.sslMode, ['--ssl-mode', self.sslMode]),
+            (self.sslSelfSigned, ['--ssl-self-signed']),
+            (self.sslCAFile, ['--ssl-ca-file', self.sslCAFile]),
+            (self.sslServerKey, ['--server-key', self.sslServerKey]),
+            (self.sslServerCert, ['--server-cert', self.sslServerCert]),
+            (not self.sslSelfSigned and not self.sslCAFile, ['--no-ssl'])
+        ]
+
+        args = []
+        for enabled, options in ssl_options:
+            if enabled:
+                args.extend(options)
+        return args
 
     def enable_ssl(self, sslMode=None, sslSelfSigned=None,
                    sslCAFile=None, sslServerKey=None, sslServerCert=None):
@@ -570,26 +1029,11 @@ class PGNode:
         self.sslCAFile = sslCAFile
         self.sslServerKey = sslServerKey
         self.sslServerCert = sslServerCert
+        self._invalidate_dsn()
 
         ssl_args = ['enable', 'ssl', '-vvv', '--pgdata', self.datadir]
 
-        if self.sslMode:
-            ssl_args += ['--ssl-mode', self.sslMode]
-
-        if self.sslSelfSigned:
-            ssl_args += ['--ssl-self-signed']
-
-        if self.sslCAFile:
-            ssl_args += ['--ssl-ca-file', self.sslCAFile]
-
-        if self.sslServerKey:
-            ssl_args += ['--server-key', self.sslServerKey]
-
-        if self.sslServerCert:
-            ssl_args += ['--server-cert', self.sslServerCert]
-
-        if not self.sslSelfSigned and not self.sslCAFile:
-            ssl_args += ['--no-ssl']
+        ssl_args.extend(self.ssl_args())
 
         command = PGAutoCtl(self, argv=ssl_args)
         out, err = command.execute("enable ssl")
@@ -633,36 +1077,20 @@ class DataNode(PGNode):
                        '--pgdata', self.datadir,
                        '--pghost', pghost,
                        '--pgport', str(self.port),
-                       '--pgctl', shutil.which('pg_ctl'),
+                       '--pgctl', _which('pg_ctl'),
                        '--auth', self.authMethod,
                        '--monitor', self.monitor.connection_string()]
 
-        if self.sslMode:
-            create_args += ['--ssl-mode', self.sslMode]
-
-        if self.sslSelfSigned:
-            create_args += ['--ssl-self-signed']
-
-        if self.sslCAFile:
-            create_args += ['--ssl-ca-file', self.sslCAFile]
-
-        if self.sslServerKey:
-            create_args += ['--server-key', self.sslServerKey]
-
-        if self.sslServerCert:
-            create_args += ['--server-cert', self.sslServerCert]
-
-        if not self.sslSelfSigned and not self.sslCAFile:
-            create_args += ['--no-ssl']
+        create_args.extend(self.ssl_args())
 
         if self.listen_flag:
-            create_args += ['--listen', str(self.vnode.address)]
+            create_args.extend(['--listen', str(self.vnode.address)])
 
         if self.formation:
-            create_args += ['--formation', self.formation]
+            create_args.extend(['--formation', self.formation])
 
         if run:
-            create_args += ['--run']
+            create_args.append('--run')
 
         # when run is requested pg_autoctl does not terminate
         # therefore we do not wait for process to complete
@@ -686,66 +1114,38 @@ class DataNode(PGNode):
         except Exception as e:
             print(str(e))
 
-        try:
-            os.remove(self.config_file_path())
-        except FileNotFoundError:
-            pass
-
-        try:
-            os.remove(self.state_file_path())
-        except FileNotFoundError:
-            pass
+        _remove_if_exists(self.config_file_path())
+        _remove_if_exists(self.state_file_path())
 
     def wait_until_state(self, target_state,
                          timeout=STATE_CHANGE_TIMEOUT,
-                         sleep_time=POLLING_INTERVAL):
+                         sleep_time=MIN_POLLING_INTERVAL):
         """
         Waits until this data node reaches the target state, and then returns
-        True. If this doesn't happen until "timeout" seconds, returns False.
-        """
-        prev_state = None
-        wait_until = dt.datetime.now() + dt.timedelta(seconds=timeout)
-        while wait_until > dt.datetime.now():
-            self.cluster.sleep(sleep_time)
+        True. If this doesn't happen until "timeout" seconds, raises an
+        Exception.
 
-            current_state = self.get_state()
-
-            # only log the state if it has changed
-            if current_state != prev_state:
-                if current_state == target_state:
-                    print("state of %s is '%s', done waiting" %
-                          (self.datadir, current_state))
-                else:
-                    print("state of %s is '%s', waiting for '%s' ..." %
-                          (self.datadir, current_state, target_state))
-
-            if current_state == target_state:
-                return True
-
-            prev_state = current_state
-
-        print("%s didn't reach %s after %d seconds" %
-              (self.datadir, target_state, timeout))
-        error_msg = (f"{self.datadir} failed to reach {target_state} "
-                     f"after {timeout} seconds\n")
-        self.print_debug_logs()
-        raise Exception(error_msg)
+        See Cluster.wait_until_states for the details.
+        """
+        return self.cluster.wait_until_states({self: target_state},
+                                              timeout, sleep_time)
 
     def get_state(self):
         """
         Returns the current state of the data node. This is done by querying the
         monitor node.
         """
-        results = self.monitor.run_sql_query(
+        results = self.monitor.run_prepared(
+            "get_state",
             """
 SELECT reportedstate
   FROM pgautofailover.node
- WHERE nodeid=%s and groupid=%s
+ WHERE nodeid=$1 and groupid=$2
 """,
             self.nodeid, self.group)
         if len(results) == 0:
-            raise Exception("node %s in group %s not found on the monitor" %
-                            (self.nodeid, self.group))
+            raise Exception(f"node {self.nodeid} in group {self.group} "
+                            "not found on the monitor")
         else:
             return results[0][0]
         return results
@@ -754,21 +1154,14 @@ SELECT reportedstate
         """
         Returns the current list of events from the monitor.
         """
-        last_events_query = "select eventtime, nodeid, nodename, " \
-            "reportedstate, goalstate, " \
-            "reportedrepstate, reportedlsn, description " \
-            "from pgautofailover.last_events('default', count => 20)"
-        return self.monitor.run_sql_query(last_events_query)
-
+        return self.monitor.get_events()
 
     def get_events_str(self):
-        return "\n".join(
-            ["%s %25s:%-14s %17s/%-17s %7s %10s %s" % ("eventtime", "id", "nodename",
-                                                       "state", "goal state",
-                                                       "repl st", "lsn", "event")]
-            +
-            ["%s %2d:%-14s %17s/%-17s %7s %10s %s" % result
-             for result in self.get_events()])
+        return "\n".join(itertools.chain(
+            [EVENTS_HEADER],
+            (f"{r[0]!s} {r[1]:2d}:{r[2]!s:<14} {r[3]!s:>17}/{r[4]!s:<17} "
+             f"{r[5]!s:>7} {r[6]!s:>10} {r[7]!s}"
+             for r in self.get_events())))
 
     def enable_maintenance(self):
         """
@@ -847,7 +1240,7 @@ SELECT reportedstate
         value = out.strip()
 
         if (value not in ['true', 'false']):
-            raise Exception("Unknown replication quorum value %s" % value)
+            raise Exception(f"Unknown replication quorum value {value}")
 
         return value == "true"
 
@@ -892,8 +1285,8 @@ SELECT reportedstate
             Returns a list of the replication slot names on the local Postgres.
         """
         query = "select slot_name from pg_replication_slots " \
-            + "where slot_name ~ '^pgautofailover_standby_' " \
-            + " and slot_type = 'physical'"
+            + "where slot_type = 'physical' " \
+            + " and slot_name like 'pgautofailover\\_standby\\_%%' escape '\\'"
 
         result = self.run_sql_query(query)
         return [row[0] for row in result]
@@ -911,27 +1304,28 @@ SELECT reportedstate
         if self.pgmajor() == 10:
             return True
 
-        print("has_needed_replication_slots: pgversion = %s, pgmajor = %s" %
-              (self.pgversion(), self.pgmajor()))
+        print(f"has_needed_replication_slots: pgversion = {self.pgversion()}, "
+              f"pgmajor = {self.pgmajor()}")
 
         hostname = str(self.vnode.address)
         other_nodes = self.monitor.get_other_nodes(hostname, self.port)
-        expected_slots = ['pgautofailover_standby_%s' % n[0] for n in other_nodes]
+        expected_slots = [f"pgautofailover_standby_{n[0]}" for n in other_nodes]
         current_slots = self.list_replication_slot_names()
 
-        # just to make it easier to read through the print()ed list
+        # just to make it easier to read through the print()ed list, and then
+        # slot names are unique so we can compare the sorted lists directly
         expected_slots.sort()
         current_slots.sort()
 
-        if set(expected_slots) == set(current_slots):
-            print("slots list on %s is %s, as expected" %
-                  (self.datadir, current_slots))
+        if expected_slots == current_slots:
+            print(f"slots list on {self.datadir} is {current_slots}, "
+                  "as expected")
             return True
 
         self.print_debug_logs()
         print()
-        print("slots list on %s is %s, expected %s" %
-              (self.datadir, current_slots, expected_slots))
+        print(f"slots list on {self.datadir} is {current_slots}, "
+              f"expected {expected_slots}")
         return False
 
 
@@ -952,6 +1346,12 @@ class MonitorNode(PGNode):
         else:
             self.nodename = str(self.vnode.address)
 
+        # connection used to LISTEN to the monitor state notifications
+        self._notify_conn = None
+
+        # see get_events
+        self._events_cache = None
+        self._events_cache_ts = 0
 
     def create(self, run = False):
         """
@@ -963,26 +1363,10 @@ class MonitorNode(PGNode):
                        '--auth', self.authMethod,
                        '--nodename', self.nodename]
 
-        if self.sslMode:
-            create_args += ['--ssl-mode', self.sslMode]
-
-        if self.sslSelfSigned:
-            create_args += ['--ssl-self-signed']
-
-        if self.sslCAFile:
-            create_args += ['--ssl-ca-file', self.sslCAFile]
-
-        if self.sslServerKey:
-            create_args += ['--server-key', self.sslServerKey]
-
-        if self.sslServerCert:
-            create_args += ['--server-cert', self.sslServerCert]
-
-        if not self.sslSelfSigned and not self.sslCAFile:
-            create_args += ['--no-ssl']
+        create_args.extend(self.ssl_args())
 
         if run:
-            create_args += ['--run']
+            create_args.append('--run')
 
         # when run is requested pg_autoctl does not terminate
         # therefore we do not wait for process to complete
@@ -1010,7 +1394,7 @@ class MonitorNode(PGNode):
 
             if out or err:
                 print()
-                print("Monitor logs:\n%s\n%s\n" % (out, err))
+                print(f"Monitor logs:\n{out}\n{err}\n")
 
         try:
             destroy = PGAutoCtl(self)
@@ -1019,15 +1403,8 @@ class MonitorNode(PGNode):
         except Exception as e:
             print(str(e))
 
-        try:
-            os.remove(self.config_file_path())
-        except FileNotFoundError:
-            pass
-
-        try:
-            os.remove(self.state_file_path())
-        except FileNotFoundError:
-            pass
+        _remove_if_exists(self.config_file_path())
+        _remove_if_exists(self.state_file_path())
 
     def create_formation(self, formation_name,
                          kind="pgsql", secondary=None, dbname=None):
@@ -1040,23 +1417,16 @@ class MonitorNode(PGNode):
         :param dbname: name of the database to use in the formation
         :return: None
         """
-        formation_command = [shutil.which('pg_autoctl'), 'create', 'formation',
-                             '--pgdata', self.datadir,
-                             '--formation', formation_name,
-                             '--kind', kind]
+        # same defaults as pg_autoctl create formation
+        if dbname is None:
+            dbname = "postgres"
 
-        if dbname is not None:
-            formation_command += ['--dbname', dbname]
-
-        # pass true or false to --enable-secondary or --disable-secondary, only when ha is
-        # actually set by the user
-        if secondary is not None:
-            if secondary:
-                formation_command += ['--enable-secondary']
-            else:
-                formation_command += ['--disable-secondary']
+        if secondary is None:
+            secondary = True
 
-        self.vnode.run_and_wait(formation_command, name="create formation")
+        self.run_sql_query(
+            "select * from pgautofailover.create_formation(%s, %s, %s, %s, 0)",
+            formation_name, kind, dbname, secondary)
 
     def enable(self, feature, formation='default'):
         """
@@ -1066,9 +1436,9 @@ class MonitorNode(PGNode):
         :param formation: name of the formation to enable the feature on
         :return: None
         """
-        command = PGAutoCtl(self)
-        command.execute("enable %s" % feature.command(),
-                        'enable', feature.command(), '--formation', formation)
+        self.run_sql_query(
+            f"select pgautofailover.enable_{feature.command()}(%s)",
+            formation)
 
     def disable(self, feature, formation='default'):
         """
@@ -1078,28 +1448,47 @@ class MonitorNode(PGNode):
         :param formation: name of the formation to disable the feature on
         :return: None
         """
-        command = PGAutoCtl(self)
-        command.execute("disable %s" % feature.command(),
-                        'disable', feature.command(), '--formation', formation)
+        self.run_sql_query(
+            f"select pgautofailover.disable_{feature.command()}(%s)",
+            formation)
 
     def failover(self, formation='default', group=0):
         """
         performs manual failover for given formation and group id
         """
-        failover_commmand_text = \
-            "select * from pgautofailover.perform_failover('%s', %s)" % \
-            (formation, group)
-        failover_command = [shutil.which('psql'),
-                            '-d', self.database,
-                            '-c', failover_commmand_text]
-        self.vnode.run_and_wait(failover_command, name="manual failover")
+        self.run_sql_query(
+            "select * from pgautofailover.perform_failover(%s, %s)",
+            formation, group)
 
     def print_state(self, formation="default"):
-        print("pg_autoctl show state --pgdata %s" % self.datadir)
+        # replication_quorum is cast to text so that it shows as t or f, as in
+        # pg_autoctl show state, rather than as a Python bool
+        query = "select nodename, nodeport, group_id, node_id, " \
+            + "current_group_state, assigned_group_state, " \
+            + "candidate_priority, replication_quorum::text " \
+            + "from pgautofailover.current_state(%s)"
 
-        command = PGAutoCtl(self)
-        out, err = command.execute("show state", 'show', 'state')
-        print("%s" % out)
+        print(STATE_HEADER)
+        for row in self.run_sql_query(query, formation):
+            print(STATE_FORMAT % row)
+
+    def get_events(self):
+        """
+        Returns the current list of events from the monitor. The result is
+        cached for EVENTS_CACHE_TTL seconds, so that several nodes printing
+        their debug logs at the same time share the same query.
+        """
+        now = time.monotonic()
+        if self._events_cache is not None and now < self._events_cache_ts:
+            return self._events_cache
+
+        last_events_query = "select eventtime, nodeid, nodename, " \
+            "reportedstate, goalstate, " \
+            "reportedrepstate, reportedlsn, description " \
+            "from pgautofailover.last_events('default', count => 20)"
+        self._events_cache = self.run_sql_query(last_events_query)
+        self._events_cache_ts = now + EVENTS_CACHE_TTL
+        return self._events_cache
 
     def get_other_nodes(self, host, port):
         """
@@ -1108,6 +1497,60 @@ class MonitorNode(PGNode):
         query = "select * from pgautofailover.get_other_nodes(%s, %s)"
         return self.run_sql_query(query, host, port)
 
+    def listen(self):
+        """
+        Opens a connection to the monitor that LISTENs to the state channel,
+        unless we already have one. Returns None when the monitor can't be
+        reached.
+        """
+        if self._notify_conn is not None and not self._notify_conn.closed:
+            return self._notify_conn
+
+        try:
+            conn = psycopg2.connect(**self._connection_kwargs())
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN state")
+        except psycopg2.Error:
+            return None
+
+        self._notify_conn = conn
+        return conn
+
+    def wait_for_notify(self, timeout):
+        """
+        Waits until the monitor sends a notification on the state channel, or
+        until timeout seconds have passed. Returns the list of notifications
+        received, which is empty when the timeout expired.
+        """
+        conn = self.listen()
+
+        if conn is None:
+            time.sleep(timeout)
+            return []
+
+        try:
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                return []
+            conn.poll()
+        except (psycopg2.Error, OSError):
+            # the monitor went away, LISTEN again next time we're called
+            conn.close()
+            return []
+
+        notifies = conn.notifies[:]
+        del conn.notifies[:]
+        return notifies
+
+    def close_connections(self):
+        """
+        Closes the connections this node keeps open to Postgres.
+        """
+        super().close_connections()
+
+        if self._notify_conn is not None:
+            self._notify_conn.close()
+            self._notify_conn = None
+
 
 class PGAutoCtl():
     def __init__(self, pgnode, argv=None):
@@ -1115,13 +1558,22 @@ class PGAutoCtl():
         self.datadir = pgnode.datadir
         self.pgnode = pgnode
 
-        self.program = shutil.which('pg_autoctl')
+        if PG_AUTOCTL is None:
+            raise Exception("pg_autoctl not found in PATH")
+
+        self.program = PG_AUTOCTL
         self.command = None
 
         self.run_proc = None
         self.last_returncode = None
         self.out = ""
         self.err = ""
+        self.pid = None
+
+        # see _drain
+        self.drain_error = None
+        self._drain_thread = None
+        self._drain_stop = threading.Event()
 
         if argv:
             self.command = [self.program] + argv
@@ -1136,10 +1588,21 @@ class PGAutoCtl():
         if not self.command:
             self.command = [self.program, 'run', '--pgdata', self.datadir, level]
 
+        # the drain thread might release the process while we wait for it,
+        # so only look at run_proc once the thread is done
+        self._stop_draining()
         if self.run_proc:
             self.run_proc.release()
         self.run_proc = self.vnode.run_unmanaged(self.command)
-        print("pg_autoctl run [%d]" % self.run_proc.pid)
+        self.pid = self.run_proc.pid
+        print(f"pg_autoctl run [{self.pid:d}]")
+
+        # read the process output in the background, so that it never gets
+        # stuck because of a filled up pipe
+        self.drain_error = None
+        self._drain_stop.clear()
+        self._drain_thread = threading.Thread(target=self._drain, daemon=True)
+        self._drain_thread.start()
 
     def execute(self, name, *args, timeout=COMMAND_TIMEOUT):
         """
@@ -1158,33 +1621,30 @@ class PGAutoCtl():
 
             self.last_returncode = proc.returncode
             if proc.returncode > 0:
-                raise Exception("%s failed\n%s\n%s\n%s" %
-                                (name,
-                                 " ".join(self.command),
-                                 out, err))
+                string_command = " ".join(self.command)
+                raise Exception(f"{name} failed\n{string_command}\n{out}\n{err}")
             return out, err
 
     def stop(self):
         """
         Kills the keeper by sending a SIGTERM to keeper's process group.
         """
-        if self.run_proc and self.run_proc.pid:
-            print("Terminating pg_autoctl process for %s [%d]" %
-                  (self.datadir, self.run_proc.pid))
+        if self.run_proc and self.pid:
+            print(f"Terminating pg_autoctl process for {self.datadir} "
+                  f"[{self.pid:d}]")
 
             try:
-                pgid = os.getpgid(self.run_proc.pid)
+                pgid = os.getpgid(self.pid)
                 os.killpg(pgid, signal.SIGQUIT)
 
                 return self.pgnode.cluster.communicate(self, COMMAND_TIMEOUT)
 
             except ProcessLookupError as e:
                 self.run_proc = None
-                print("Failed to terminate pg_autoctl for %s: %s" %
-                      (self.datadir, e))
+                print(f"Failed to terminate pg_autoctl for {self.datadir}: {e}")
                 return None, None
         else:
-            print("pg_autoctl process for %s is not running" % self.datadir)
+            print(f"pg_autoctl process for {self.datadir} is not running")
             return None, None
 
     def communicate(self, timeout=COMMAND_TIMEOUT):
@@ -1195,6 +1655,17 @@ class PGAutoCtl():
         successful call, then it returns the results from when the process
         exited originally.
         """
+        drain_thread = self._drain_thread
+        if drain_thread is not None:
+            # the output is read by the drain thread, wait until it's done
+            drain_thread.join(timeout)
+            if drain_thread.is_alive():
+                raise subprocess.TimeoutExpired(self.command, timeout)
+            return self.out, self.err
+
+        return self._communicate(timeout)
+
+    def _communicate(self, timeout):
         if not self.run_proc:
             return self.out, self.err
 
@@ -1208,9 +1679,46 @@ class PGAutoCtl():
 
         return self.out, self.err
 
+    def _drain(self):
+        """
+        Reads the output of the running process until it exits, or until we
+        are asked to stop. This runs in its own thread, which is then the only
+        one to talk to the process: NSPopen objects are not thread-safe.
+        """
+        while not self._drain_stop.is_set():
+            try:
+                self._communicate(timeout=DRAIN_INTERVAL)
+                return
+            except subprocess.TimeoutExpired:
+                # all good, we'll comme back
+                pass
+            except Exception as e:
+                # we can't talk to the process anymore: record why, and
+                # forget about it so that running() doesn't stay true
+                self.drain_error = e
+                self.err = (f"{self.err}\n"
+                            f"Failed to read pg_autoctl output: {e!r}\n")
+                print(f"Failed to read the output of pg_autoctl for "
+                      f"{self.datadir}: {e!r}")
+
+                with contextlib.suppress(Exception):
+                    self.run_proc.release()
+                self.run_proc = None
+                return
+
+    def _stop_draining(self):
+        """
+        Stops the drain thread, if any, and waits until it's done.
+        """
+        if self._drain_thread is not None:
+            self._drain_stop.set()
+            self._drain_thread.join()
+            self._drain_thread = None
+
     def consume_output(self, secs):
         """
-        Read available lines from the process for some given seconds
+        Wait for some given seconds, or until the process exits, while its
+        output is being read in the background
         """
         try:
             self.out, self.err = self.communicate(timeout=secs)
@@ -1228,16 +1736,20 @@ class PGAutoCtl():
             return self.command
 
         pgdata = ['--pgdata', self.datadir]
+        pgdata_added = False
         self.command = [self.program]
 
         # add pgdata in the command BEFORE any -- arguments
         for arg in args:
             if arg == '--':
-                self.command += pgdata
-            self.command += [arg]
+                self.command.extend(pgdata)
+                pgdata_added = True
+            elif arg == '--pgdata':
+                pgdata_added = True
+            self.command.append(arg)
 
         # when no -- argument is used, append --pgdata option at the end
-        if '--pgdata' not in self.command:
-            self.command += pgdata
+        if not pgdata_added:
+            self.command.extend(pgdata)
 
         return self.command
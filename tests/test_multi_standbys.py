@@ -6,6 +6,8 @@ cluster = None
 monitor = None
 node1 = None
 node2 = None
+node3 = None
+node4 = None
 
 def setup_module():
     global cluster
@@ -78,3 +80,19 @@ def test_005_number_sync_standbys():
     assert node1.get_number_sync_standbys() == 1
     print("synchronous_standby_names = '%s'" %
           node1.get_synchronous_standby_names())
+
+def test_006_add_standbys():
+    # those standbys don't depend on each other, create them at once
+    global node3, node4
+
+    node3, node4 = cluster.create_datanodes_parallel(
+        [{"datadir": "/tmp/multi_standby/node3"},
+         {"datadir": "/tmp/multi_standby/node4"}])
+
+    assert cluster.wait_until_states({node2: "secondary",
+                                      node3: "secondary",
+                                      node4: "secondary",
+                                      node1: "primary"})
+
+    assert node1.set_number_sync_standbys(2)
+    assert node1.get_number_sync_standbys() == 2
@@ -17,6 +17,8 @@ expected_ciphers = (
     "ECDHE-RSA-AES128-SHA256:"
     "ECDHE-RSA-AES256-SHA384"
 )
+_SSL_FILES = (("ssl_key_file", "server.key"),
+              ("ssl_cert_file", "server.crt"))
 
 
 def setup_module():
@@ -29,11 +31,11 @@ def teardown_module():
 
 
 def check_ssl_files(node):
-    for setting, f in [("ssl_key_file", "server.key"),
-                       ("ssl_cert_file", "server.crt")]:
+    settings = node.pg_config_get_many([setting for setting, _ in _SSL_FILES])
+    for setting, f in _SSL_FILES:
         file_path = os.path.join(node.datadir, f)
         assert os.path.isfile(file_path)
-        eq_(node.pg_config_get(setting), file_path)
+        eq_(settings[setting], file_path)
 
 
 def check_ssl_ciphers(node):